@@ -1,179 +1,571 @@
+import functools
+import hashlib
+import io
+import os
+import threading
+import time
+import traceback
+import unicodedata
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import cohere
+import httpx
+import numpy as np
 import streamlit as st
-from supabase import create_client
+import tiktoken
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from postgrest.types import ReturnMethod
+from supabase import ClientOptions, create_client
 import openai
 
+from query_normalization import normalize_query
+
+DEBUG = bool(os.environ.get("DEBUG"))
+
+CHAT_MODEL = "gpt-4o-mini"
+CHAT_TEMPERATURE = 0.85
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512
+EMBEDDING_CACHE_MAX_AGE = timedelta(days=30)
+RESPONSE_CACHE_THRESHOLD = 0.93
+RESPONSE_CACHE_MAX_AGE = timedelta(hours=24)
+STREAM_FLUSH_CHARS = 40
+STREAM_FLUSH_INTERVAL = 0.05
+REPLAY_CHUNK_CHARS = 16
+REPLAY_DELAY = 0.01
+CHAT_HISTORY_MAX_AGE = timedelta(hours=1)
+CHAT_HISTORY_MAX_MESSAGES = 50
+HISTORY_DISPLAY_MESSAGES = 20
+FILTER_OPTIONS_TTL = 3600
+DB_STATS_TTL = 300
+CONTEXT_TOKEN_BUDGET = 24000
+CONTEXT_WINDOW_TOKENS = 1500
+EXCERPT_CHARS_PER_TOKEN = 8
+RERANK_MODEL = "rerank-v3.5"
+RERANK_CANDIDATE_FACTOR = 3
+# The prompt is the only part of a request not bounded elsewhere. At ~2K
+# tokens it keeps preamble + CONTEXT_TOKEN_BUDGET + prompt + response detail
+# far inside gpt-4o-mini's 128K window, so no per-request size check is needed.
+MAX_PROMPT_CHARS = 8000
+
 st.set_page_config(page_title="Islamic Scholar AI", page_icon="📚", layout="wide")
 
-st.markdown("""
-<style>
-    .stApp { max-width: 1400px; margin: 0 auto; }
-    h1 { color: #1e3a8a; text-align: center; padding: 1rem 0; }
-</style>
-""", unsafe_allow_html=True)
+@st.cache_resource
+def load_css():
+    with open(Path(__file__).parent / "static" / "style.css") as f:
+        return f"<style>{f.read()}</style>"
+
+st.html(load_css())
 
 @st.cache_resource
 def init_connections():
-    supabase = create_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_KEY"])
-    openai.api_key = st.secrets["OPENAI_KEY"]
-    return supabase
+    # One keep-alive HTTP/2 client for all PostgREST calls, so queries reuse
+    # a warm TLS connection instead of handshaking each time
+    # A supplied client's timeout replaces postgrest's own 120s default, so
+    # set it explicitly rather than inherit httpx's 5s
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=120),
+        timeout=120
+    )
+    supabase = create_client(
+        st.secrets["SUPABASE_URL"],
+        st.secrets["SUPABASE_KEY"],
+        options=ClientOptions(httpx_client=http_client)
+    )
+    # Same for OpenAI: embeddings, routing checks and completions share one
+    # pooled HTTP/2 connection instead of each paying for a cold handshake
+    openai_client = openai.OpenAI(
+        api_key=st.secrets["OPENAI_KEY"],
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=120),
+            timeout=60
+        )
+    )
+    return supabase, openai_client
 
-supabase = init_connections()
+supabase, openai_client = init_connections()
 
-@st.cache_data(ttl=3600)
-def get_authors():
-    try:
-        result = supabase.table('source_documents').select('author').execute()
-        authors = list(set([r['author'] for r in result.data if r.get('author')]))
-        return ['All Sources'] + sorted(authors)
-    except:
-        return ['All Sources']
-
-@st.cache_data(ttl=3600)
-def get_source_types():
-    try:
-        result = supabase.table('source_documents').select('source_type').execute()
-        types = list(set([r['source_type'] for r in result.data if r.get('source_type')]))
-        return ['All Types'] + sorted(types)
-    except:
-        return ['All Types', 'video', 'book']
-
-def search_and_retrieve(query, author_filter='All Sources', source_type_filter='All Types', num_results=7):
-    """Search and return full documents"""
-    try:
-        embedding_response = openai.embeddings.create(input=query, model="text-embedding-3-small")
-        query_embedding = embedding_response.data[0].embedding
-        
-        results = supabase.rpc('match_documents_hybrid', {
-            'query_embedding': query_embedding,
-            'match_count': num_results * 2
-        }).execute()
-        
-        if not results.data:
-            return []
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=16, thread_name_prefix="prefetch")
+
+def run_in_background(fn, *args):
+    """Run fn on the shared executor with this session's script context attached"""
+    ctx = get_script_run_ctx()
+    
+    def task():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+    
+    return get_executor().submit(task)
+
+@st.cache_resource
+def cache_counters():
+    """Per-process call/miss counts for the @st.cache_data functions below"""
+    return {}
+
+def record_cache_call(name):
+    cache_counters().setdefault(name, {'calls': 0, 'misses': 0})['calls'] += 1
+
+def record_cache_miss(name):
+    cache_counters().setdefault(name, {'calls': 0, 'misses': 0})['misses'] += 1
+
+@st.cache_resource
+def prompt_cache_usage():
+    """Per-process prompt token totals, and how many OpenAI served from its prompt cache"""
+    return {'prompt_tokens': 0, 'cached_tokens': 0}
+
+def record_prompt_cache_usage(usage):
+    details = usage.prompt_tokens_details
+    totals = prompt_cache_usage()
+    totals['prompt_tokens'] += usage.prompt_tokens
+    totals['cached_tokens'] += (details.cached_tokens or 0) if details else 0
+
+def observe_cache(name):
+    """Count calls to a @st.cache_data function; apply above the cache decorator.
+    
+    The cached body calls record_cache_miss(name), which only runs on a miss.
+    """
+    def decorate(cached_fn):
+        @functools.wraps(cached_fn)
+        def wrapper(*args, **kwargs):
+            record_cache_call(name)
+            return cached_fn(*args, **kwargs)
+        wrapper.clear = cached_fn.clear
+        return wrapper
+    return decorate
+
+@st.cache_resource
+def stale_values():
+    return {'lock': threading.Lock(), 'first_loads': {}, 'entries': {}}
+
+def is_loaded(name):
+    """Whether stale_while_revalidate(name, ...) can answer without a fetch"""
+    return name in stale_values()['entries']
+
+def stale_while_revalidate(name, fetch, ttl, fallback):
+    """Return fetch()'s last value at once, refreshing it in the background when stale.
+    
+    Only the first load in a process waits on fetch(); after that an expired
+    value is still served while a single background refresh replaces it.
+    A failed refresh keeps the stale value; fallback is only returned (and
+    not stored) while no fetch has ever succeeded.
+    """
+    store = stale_values()
+    entry = store['entries'].get(name)
+    record_cache_call(name)
+    
+    if entry is None:
+        with store['lock']:
+            first_load = store['first_loads'].setdefault(name, threading.Lock())
         
-        filtered_docs = []
-        seen_ids = set()
+        # Concurrent cold callers wait on the one first load instead of each
+        # fetching; the lock is per name so different values still load in parallel
+        with first_load:
+            entry = store['entries'].get(name)
+            if entry is None:
+                record_cache_miss(name)
+                try:
+                    value = fetch()
+                except Exception:
+                    return fallback
+                store['entries'][name] = entry = {'value': value, 'fetched_at': time.monotonic(), 'refreshing': False}
+        return entry['value']
+    
+    if time.monotonic() - entry['fetched_at'] > ttl:
+        with store['lock']:
+            start_refresh = not entry['refreshing']
+            entry['refreshing'] = True
         
-        for result in results.data:
-            if result['parent_id'] in seen_ids:
-                continue
-            
-            if author_filter != 'All Sources' and result['parent_author'] != author_filter:
-                continue
+        if start_refresh:
+            record_cache_miss(name)
             
-            if source_type_filter != 'All Types' and result['parent_type'] != source_type_filter:
-                continue
-            
-            filtered_docs.append({
-                'id': result['parent_id'],
-                'title': result['parent_title'],
-                'content': result['parent_content'],
-                'type': result['parent_type'],
-                'author': result['parent_author'],
-                'metadata': result['parent_metadata'],
-                'url': result['parent_url'],
-                'matched_chunk': result['chunk_content'],
-                'similarity': result['similarity']
-            })
-            
-            seen_ids.add(result['parent_id'])
+            def refresh():
+                try:
+                    entry['value'] = fetch()
+                    entry['fetched_at'] = time.monotonic()
+                except Exception:
+                    pass  # keep serving the stale value; the next call retries
+                finally:
+                    entry['refreshing'] = False
             
-            if len(filtered_docs) >= num_results:
-                break
-        
-        return filtered_docs
-        
-    except Exception as e:
-        st.error(f"Search error: {str(e)}")
+            run_in_background(refresh)
+    
+    return entry['value']
+
+def _fetch_filter_options():
+    options = supabase.rpc('get_filter_options').execute().data
+    return ['All Sources'] + options['authors'], ['All Types'] + options['source_types']
+
+def get_filter_options():
+    """(authors, source_types) for the sidebar filters, each led by its 'All' option"""
+    return stale_while_revalidate(
+        "get_filter_options", _fetch_filter_options, FILTER_OPTIONS_TTL,
+        fallback=(['All Sources'], ['All Types', 'video', 'book'])
+    )
+
+def get_session_id():
+    """Per-tab chat id, kept server-side so it never appears in a shareable URL"""
+    if "chat_session_id" not in st.session_state:
+        st.session_state.chat_session_id = uuid.uuid4().hex
+    return st.session_state.chat_session_id
+
+def history_version():
+    """Bumped on every write to this session's history, to key load_messages"""
+    return st.session_state.get("chat_history_version", 0)
+
+def bump_history_version():
+    st.session_state.chat_history_version = history_version() + 1
+
+# version is part of the cache key only: a write bumps it so this session
+# reads fresh history, without clearing every other session's entry
+@observe_cache("load_messages")
+@st.cache_data(ttl=5, show_spinner=False)
+def load_messages(session_id, version):
+    record_cache_miss("load_messages")
+    cutoff = (datetime.now(timezone.utc) - CHAT_HISTORY_MAX_AGE).isoformat()
+    try:
+        return supabase.rpc('get_chat_messages', {
+            'chat_session_id': session_id,
+            'since': cutoff,
+            'max_messages': CHAT_HISTORY_MAX_MESSAGES
+        }).execute().data
+    except Exception:
         return []
 
-# ========== UI ==========
+def save_message(session_id, role, content):
+    try:
+        supabase.rpc('add_chat_message', {
+            'chat_session_id': session_id,
+            'message_role': role,
+            'message_content': content
+        }).execute()
+    except Exception:
+        pass
+    bump_history_version()
 
-authors = get_authors()
-source_types = get_source_types()
+def clear_messages(session_id):
+    try:
+        supabase.rpc('clear_chat_messages', {'chat_session_id': session_id}).execute()
+    except Exception:
+        pass
+    bump_history_version()
 
-st.title("📚 Islamic Scholar AI - Dawah Assistant")
-st.caption("Islamic guidance grounded in authentic sources")
+def _fetch_db_stats():
+    return supabase.rpc('get_db_stats').execute().data
 
-col1, col2 = st.columns([2, 1])
+def get_db_stats():
+    """Document/chunk counts for the sidebar, or None until they first load"""
+    return stale_while_revalidate("get_db_stats", _fetch_db_stats, DB_STATS_TTL, fallback=None)
 
-with col2:
-    st.markdown("### ⚙️ Settings")
+def _embedding_cache_key(text):
+    return hashlib.sha256(f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}\0{text}".encode()).hexdigest()
+
+def embed_texts(texts):
+    """Embed several texts in one OpenAI request, skipping persisted cache hits.
     
-    selected_author = st.selectbox("Filter by Author:", authors)
-    selected_type = st.selectbox("Filter by Source Type:", source_types)
+    Embeddings come back as float32 arrays: a tenth of the memory of a list
+    of Python floats, which matters for the in-process query cache.
+    """
+    keys = [_embedding_cache_key(text) for text in texts]
+    cutoff = (datetime.now(timezone.utc) - EMBEDDING_CACHE_MAX_AGE).isoformat()
+    embeddings = {}
     
-    num_sources = st.slider(
-        "Number of sources:", 
-        min_value=2, 
-        max_value=8, 
-        value=5,  # Default to 5 (was 7)
-        help="⚠️ More sources may hit token limits"
-    )
+    try:
+        cached = supabase.table('embedding_cache').select('key, embedding').in_('key', list(set(keys))).gte('created_at', cutoff).execute()
+        embeddings = {row['key']: np.asarray(row['embedding'], dtype=np.float32) for row in cached.data}
+    except Exception:
+        pass
     
-    response_detail = st.slider(
-        "Response detail:", 
-        min_value=800, 
-        max_value=2000, 
-        value=1500,  # Reduced from 2000
-        help="Length of AI response"
-    )
+    uncached = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in embeddings))
+    if uncached:
+        embedding_response = openai_client.embeddings.create(input=uncached, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+        now = datetime.now(timezone.utc).isoformat()
+        rows = []
+        
+        for item in embedding_response.data:
+            key = _embedding_cache_key(uncached[item.index])
+            embeddings[key] = np.asarray(item.embedding, dtype=np.float32)
+            rows.append({'key': key, 'model': EMBEDDING_MODEL, 'embedding': item.embedding, 'created_at': now})
+        
+        try:
+            supabase.table('embedding_cache').upsert(rows, on_conflict='key', returning=ReturnMethod.minimal).execute()
+        except Exception:
+            pass
     
-    st.markdown("---")
-    st.markdown("### 📊 Database")
+    return [embeddings[key] for key in keys]
+
+# The normalized form is only a cache key; the model always sees the query
+# itself (NFKC-normalized), with its punctuation and casing intact. The
+# leading underscore keeps _query out of st.cache_data's hash.
+@observe_cache("query_embedding")
+@st.cache_data(ttl=86400, max_entries=10000, show_spinner=False)
+def _embed_query(key, _query):
+    record_cache_miss("query_embedding")
+    return embed_texts([_query])[0]
+
+def get_query_embedding(prompt):
+    """Embed a query, reusing the persisted embedding cache when possible"""
+    return _embed_query(normalize_query(prompt), unicodedata.normalize("NFKC", prompt).strip())
+
+def to_pgvector(embedding):
+    """Serialize an embedding as a compact pgvector literal at float16 precision.
+    
+    Stored chunk embeddings are halfvec, so digits beyond fp16 precision
+    would only be parsed and thrown away.
+    """
+    return "[" + ",".join(f"{x:.4g}" for x in np.asarray(embedding, dtype=np.float16)) + "]"
+
+def find_cached_response(query_embedding, author_filter, source_type_filter):
+    """Return a recent answer (with its sources) to a near-identical question, if any"""
+    try:
+        result = supabase.rpc('match_response_cache', {
+            'query_embedding': to_pgvector(query_embedding),
+            'author_filter': author_filter,
+            'type_filter': source_type_filter,
+            'match_threshold': RESPONSE_CACHE_THRESHOLD,
+            'max_age_hours': RESPONSE_CACHE_MAX_AGE // timedelta(hours=1)
+        }).execute()
+        return result.data[0] if result.data else None
+    except Exception:
+        return None
+
+def cache_response(query_embedding, author_filter, source_type_filter, prompt, response, sources):
     try:
-        doc_count = supabase.table('source_documents').select('id', count='exact').execute()
-        chunk_count = supabase.table('document_chunks').select('id', count='exact').execute()
-        st.metric("Documents", doc_count.count)
-        st.metric("Chunks", chunk_count.count)
-    except:
+        supabase.table('response_cache').insert({
+            'author': author_filter,
+            'source_type': source_type_filter,
+            'embedding': to_pgvector(query_embedding),
+            'prompt': prompt,
+            'response': response,
+            # Only what render_sources shows; full documents are not needed again
+            'sources': [{key: source[key] for key in ('id', 'title', 'author', 'type', 'url', 'similarity', 'matched_chunk')} for source in sources]
+        }, returning=ReturnMethod.minimal).execute()
+    except Exception:
         pass
+
+ROUTER_PROMPT = """Decide whether answering the user's message requires looking up Islamic sources (Quran, Hadith, scholarship, history, arguments for Islam).
+
+Greetings, thanks, and small talk do not. Reply with a single letter: Y or N.
+
+Example: "thanks, that was helpful!" -> N"""
+
+SMALL_TALK_PROMPT = """You are an Islamic scholar making dawah. The user's message is a greeting, thanks, or small talk that does not need any sources. Reply briefly and warmly, and invite them to ask about Islam."""
+
+@observe_cache("needs_sources")
+@st.cache_data(ttl=86400, max_entries=10000, show_spinner=False)
+def _needs_sources(key, _query):
+    record_cache_miss("needs_sources")
+    try:
+        response = openai_client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": ROUTER_PROMPT},
+                {"role": "user", "content": _query}
+            ],
+            temperature=0,
+            max_tokens=3
+        )
+        return not response.choices[0].message.content.strip().upper().startswith("N")
+    except Exception:
+        return True
+
+def needs_sources(prompt):
+    """Whether a message needs retrieval; small talk is answered without it"""
+    return _needs_sources(normalize_query(prompt), prompt)
+
+def match_sources_after(embedding_future, author_filter, source_type_filter, num_results):
+    """match_sources for an embedding still being computed; queued after it, so never starves it"""
+    return match_sources(embedding_future.result(), author_filter, source_type_filter, num_results)
+
+def start_prompt_work(prompt):
+    """Start the routing check, embedding and vector search for a prompt side by side.
     
-    st.markdown("---")
-    st.info("🤖 Using gpt-4o-mini\n\n⚡ 200K token limit\n\n💡 5 sources = optimal quality")
+    The router only picks between the small-talk reply and the sourced answer;
+    retrieval never waits for it.
+    """
+    state = st.session_state
+    futures = {}
+    if not state.get("always_search"):
+        futures['needs_sources'] = run_in_background(needs_sources, prompt)
+    futures['embedding'] = run_in_background(get_query_embedding, prompt)
+    futures['candidates'] = run_in_background(
+        match_sources_after, futures['embedding'], state.selected_author, state.selected_type, state.num_sources
+    )
+    return futures
+
+def prefetch_for_prompt():
+    """Start the per-prompt API calls while the rest of the page reruns"""
+    prompt = st.session_state.get("chat_prompt")
+    if prompt:
+        st.session_state.prompt_prefetch = (prompt, start_prompt_work(prompt))
+
+def take_prefetched(prompt):
+    """The futures for prompt, taken from the on_submit prefetch when it ran for this prompt"""
+    prefetched_prompt, futures = st.session_state.pop("prompt_prefetch", (None, {}))
+    return futures if prefetched_prompt == prompt else start_prompt_work(prompt)
+
+def stream_completion(messages, max_tokens):
+    """Stream a chat completion into a new placeholder and return the full text"""
+    response = openai_client.chat.completions.create(
+        model=CHAT_MODEL,
+        messages=messages,
+        stream=True,
+        temperature=CHAT_TEMPERATURE,
+        max_tokens=max_tokens,
+        stream_options={"include_usage": True}
+    )
     
-    st.markdown("---")
-    if st.button("🗑️ Clear Chat"):
-        st.session_state.messages = []
-        st.rerun()
+    message_placeholder = st.empty()
+    response_parts = []
+    pending_chars = 0
+    last_flush = time.monotonic()
+    
+    for chunk in response:
+        # The final chunk carries only usage, with no choices
+        if chunk.usage:
+            record_prompt_cache_usage(chunk.usage)
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.content
+        if content:
+            response_parts.append(content)
+            pending_chars += len(content)
+            # Each render resends the whole answer so far; only re-render once
+            # enough new text has built up or enough time has passed
+            if pending_chars > STREAM_FLUSH_CHARS or time.monotonic() - last_flush > STREAM_FLUSH_INTERVAL:
+                message_placeholder.markdown("".join(response_parts) + "▌")
+                pending_chars = 0
+                last_flush = time.monotonic()
+    
+    full_response = "".join(response_parts)
+    message_placeholder.markdown(full_response)
+    return full_response
 
+def replay_response(placeholder, text):
+    """Type out a cached answer so cache hits look like a live stream"""
+    for end in range(REPLAY_CHUNK_CHARS, len(text), REPLAY_CHUNK_CHARS):
+        placeholder.markdown(text[:end] + "▌")
+        time.sleep(REPLAY_DELAY)
+    placeholder.markdown(text)
 
-with col1:
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+@st.cache_resource
+def get_reranker():
+    """Cohere client for reranking, or None when no COHERE_API_KEY is configured"""
+    if "COHERE_API_KEY" not in st.secrets:
+        return None
+    return cohere.ClientV2(api_key=st.secrets["COHERE_API_KEY"])
+
+def rerank_sources(query, sources, top_n):
+    """Keep the top_n sources by reranker score, falling back to vector order"""
+    reranker = get_reranker()
+    if reranker is None or len(sources) <= top_n:
+        return sources[:top_n]
     
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    try:
+        response = reranker.rerank(
+            model=RERANK_MODEL,
+            query=query,
+            documents=[source['chunk_content'] for source in sources],
+            top_n=top_n
+        )
+        return [sources[result.index] for result in response.results]
+    except Exception:
+        return sources[:top_n]
+
+def match_sources(query_embedding, author_filter='All Sources', source_type_filter='All Types', num_results=7):
+    """Vector-search candidate documents, before reranking; errors propagate to the caller"""
+    # With a reranker, over-fetch candidates so it has something to choose from
+    match_count = num_results * RERANK_CANDIDATE_FACTOR if get_reranker() else num_results
+    
+    results = supabase.rpc('match_documents_hybrid', {
+        'query_embedding': to_pgvector(query_embedding),
+        'match_count': match_count,
+        'author_filter': None if author_filter == 'All Sources' else author_filter,
+        'type_filter': None if source_type_filter == 'All Types' else source_type_filter
+    }).execute()
+    
+    # The RPC returns one row per parent document, best chunk first
+    return [{
+        'id': result['parent_id'],
+        'title': result['parent_title'],
+        'content': result['parent_content'],
+        'type': result['parent_type'],
+        'author': result['parent_author'],
+        'metadata': result['parent_metadata'],
+        'url': result['parent_url'],
+        'token_count': result['parent_token_count'],
+        'matched_chunk': result['chunk_preview'],
+        'chunk_content': result['chunk_content'],
+        'similarity': result['similarity']
+    } for result in results.data]
+
+@st.cache_resource
+def get_encoder():
+    return tiktoken.encoding_for_model(CHAT_MODEL)
+
+def excerpt_tokens(source, encoder):
+    """Tokens of a source, cut to a window around its best-matching chunk.
+    
+    Only a character slice around the match is tokenized, never the whole
+    document; EXCERPT_CHARS_PER_TOKEN characters per token comfortably
+    covers the window for English and Arabic text alike.
+    """
+    content = source['content']
+    match_at = max(content.find(source['matched_chunk'][:200]), 0)
+    reach = 2 * CONTEXT_WINDOW_TOKENS * EXCERPT_CHARS_PER_TOKEN
     
-    if prompt := st.chat_input("Ask a question..."):
-        st.session_state.messages.append({"role": "user", "content": prompt})
+    before = encoder.encode(content[max(0, match_at - reach):match_at])
+    after = encoder.encode(content[match_at:match_at + reach])
+    # Centre on the match, shifting the window inward near either end
+    take_before = min(len(before), max(CONTEXT_WINDOW_TOKENS, 2 * CONTEXT_WINDOW_TOKENS - len(after)))
+    return before[len(before) - take_before:] + after[:2 * CONTEXT_WINDOW_TOKENS - take_before]
+
+def build_context(sources, budget=CONTEXT_TOKEN_BUDGET):
+    """Pack sources into the prompt context until the token budget is spent.
+    
+    Long documents contribute only the CONTEXT_WINDOW_TOKENS either side
+    of their matched chunk. Returns the context string and how many sources
+    made it in; the last source included may be truncated to fit.
+    """
+    encoder = get_encoder()
+    context = io.StringIO()
+    num_used = 0
+    remaining = budget
+    
+    for i, source in enumerate(sources, 1):
+        header = f"=== SOURCE {i}: {source['title']} by {source['author']} ===\n\n"
+        remaining -= len(encoder.encode(header))
+        if remaining <= 0:
+            break
         
-        with st.chat_message("user"):
-            st.markdown(prompt)
+        # token_count is filled in at ingestion; only tokenize when it is
+        # missing or the document has to be cut down
+        content = source['content']
+        token_count = source['token_count']
+        if token_count is None or token_count > min(remaining, 2 * CONTEXT_WINDOW_TOKENS):
+            tokens = excerpt_tokens(source, encoder)[:remaining]
+            content = encoder.decode(tokens)
+            token_count = len(tokens)
+        if num_used:
+            context.write("\n\n")
+            remaining -= 1
+        context.write(header)
+        context.write(content)
+        num_used += 1
         
-        with st.chat_message("assistant"):
-            with st.spinner("Consulting sources..."):
-                try:
-                    sources = search_and_retrieve(
-                        query=prompt,
-                        author_filter=selected_author,
-                        source_type_filter=selected_type,
-                        num_results=num_sources
-                    )
-                    
-                    if not sources:
-                        st.error("No relevant sources found. Try different filters.")
-                        st.stop()
-                    
-                    # Build context from full documents
-                    context_parts = []
-                    for i, source in enumerate(sources, 1):
-                        context_parts.append(f"=== SOURCE {i}: {source['title']} by {source['author']} ===\n\n{source['content']}\n\n")
-                    
-                    full_context = "\n".join(context_parts)
-                    
-                    system_message = f"""You are an Islamic scholar making dawah. Your purpose: prove Islam's truth using evidence from Islamic texts, history, and reason.
+        remaining -= token_count
+        if remaining <= 0:
+            break
+    
+    return context.getvalue(), num_used
+
+SYSTEM_PREAMBLE = """You are an Islamic scholar making dawah. Your purpose: prove Islam's truth using evidence from Islamic texts, history, and reason.
 
 **CRITICAL INSTRUCTION:**
 
@@ -352,56 +744,217 @@ The sources are your INFORMATION SOURCE.
 The Quran, Hadith, history, science, logic are your EVIDENCE.
 
 Extract evidence FROM sources.
-Present evidence WITHOUT mentioning sources.
+Present evidence WITHOUT mentioning sources."""
 
-Available sources (extract the evidence within these):
+CONTEXT_TEMPLATE = """Available sources (extract the evidence within these):
 
 {full_context}
 
 Now build your case using the actual Islamic evidence these sources contain."""
 
-                    # Use gpt-4o-mini (200K TPM limit!)
-                    response = openai.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=[
-                            {"role": "system", "content": system_message},
+def build_context_message(sources):
+    """Build the context system message for the retrieved sources.
+    
+    Returns the message and the sources that fit in CONTEXT_TOKEN_BUDGET.
+    """
+    full_context, num_used = build_context(sources)
+    return CONTEXT_TEMPLATE.format(full_context=full_context), sources[:num_used]
+
+def render_sources(sources):
+    """Expander listing the retrieved sources with links and match previews"""
+    with st.expander(f"📚 {len(sources)} Sources Used", expanded=False):
+        for i, source in enumerate(sources, 1):
+            st.markdown(f"### [{i}] {source['title']}")
+            st.caption(f"**{source['author']}** • {source['type'].capitalize()}")
+            
+            if source['url']:
+                st.markdown(f"🔗 [View Source]({source['url']})")
+            
+            similarity_pct = round(source['similarity'] * 100, 1)
+            st.progress(source['similarity'], text=f"Relevance: {similarity_pct}%")
+            
+            with st.expander("Preview"):
+                st.markdown(f"_{source['matched_chunk']}..._")
+            
+            st.markdown("---")
+            
+# ========== UI ==========
+
+# Once loaded, both are served from memory and called directly. Only cold
+# loads, which are independent round trips, go to the executor to run side
+# by side rather than one after another.
+if is_loaded("get_filter_options") and is_loaded("get_db_stats"):
+    authors, source_types = get_filter_options()
+    db_stats = get_db_stats()
+else:
+    filter_options_future = run_in_background(get_filter_options)
+    db_stats_future = run_in_background(get_db_stats)
+    authors, source_types = filter_options_future.result()
+    db_stats = db_stats_future.result()
+session_id = get_session_id()
+
+# Both panels are fragments: moving a slider reruns only the settings panel,
+# and a new chat turn reruns only the chat panel, instead of the whole page
+# (and every past message) rerendering on each interaction. The chat panel
+# reads the current settings back from st.session_state via the widget keys.
+
+@st.fragment
+def settings_panel(authors, source_types, db_stats, session_id):
+    st.markdown("### ⚙️ Settings")
+    
+    st.selectbox("Filter by Author:", authors, key="selected_author")
+    st.selectbox("Filter by Source Type:", source_types, key="selected_type")
+    
+    st.slider(
+        "Number of sources:", 
+        min_value=2, 
+        max_value=8, 
+        value=5,  # Default to 5 (was 7)
+        help="⚠️ More sources may hit token limits",
+        key="num_sources"
+    )
+    
+    st.slider(
+        "Response detail:", 
+        min_value=800, 
+        max_value=2000, 
+        value=1500,  # Reduced from 2000
+        help="Length of AI response",
+        key="response_detail"
+    )
+    
+    st.toggle(
+        "Always consult sources",
+        key="always_search",
+        help="Skip the check that answers greetings and small talk without retrieval"
+    )
+    
+    st.markdown("---")
+    st.markdown("### 📊 Database")
+    if db_stats:
+        st.metric("Documents", db_stats['docs'])
+        st.metric("Chunks", db_stats['chunks'])
+    
+    if DEBUG:
+        with st.expander("🔍 Cache hit rates"):
+            for name, counts in sorted(cache_counters().items()):
+                hits = counts['calls'] - counts['misses']
+                st.caption(f"{name}: {hits}/{counts['calls']} hits")
+            tokens = prompt_cache_usage()
+            if tokens['prompt_tokens']:
+                st.caption(f"OpenAI prompt cache: {tokens['cached_tokens']}/{tokens['prompt_tokens']} prompt tokens cached")
+    
+    st.markdown("---")
+    st.info(f"🤖 Using {CHAT_MODEL}\n\n⚡ 200K token limit\n\n💡 5 sources = optimal quality")
+    
+    st.markdown("---")
+    if st.button("🗑️ Clear Chat"):
+        clear_messages(session_id)
+        st.rerun()
+
+@st.fragment
+def chat_panel(session_id):
+    selected_author = st.session_state.selected_author
+    selected_type = st.session_state.selected_type
+    num_sources = st.session_state.num_sources
+    response_detail = st.session_state.response_detail
+    always_search = st.session_state.always_search
+    
+    # Render only the latest turns unless asked; older ones cost a markdown
+    # render on every rerun of this fragment
+    messages = load_messages(session_id, history_version())
+    hidden = 0 if st.session_state.get("show_full_history") else max(len(messages) - HISTORY_DISPLAY_MESSAGES, 0)
+    if hidden and st.button(f"Show {hidden} older messages"):
+        st.session_state.show_full_history = True
+        hidden = 0
+    
+    for message in messages[hidden:]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+    
+    if prompt := st.chat_input("Ask a question...", key="chat_prompt", max_chars=MAX_PROMPT_CHARS, on_submit=prefetch_for_prompt):
+        save_message(session_id, "user", prompt)
+        
+        with st.chat_message("user"):
+            st.markdown(prompt)
+        
+        with st.chat_message("assistant"):
+            with st.spinner("Consulting sources..."):
+                try:
+                    work = take_prefetched(prompt)
+                    
+                    if not always_search and not work['needs_sources'].result():
+                        full_response = stream_completion([
+                            {"role": "system", "content": SMALL_TALK_PROMPT},
                             {"role": "user", "content": prompt}
-                        ],
-                        stream=True,
-                        temperature=0.85,
-                        max_tokens=response_detail
-                    )
+                        ], response_detail)
+                        save_message(session_id, "assistant", full_response)
+                        st.stop()
+                    
+                    # The vector search has been running since submit, alongside the
+                    # router and this response-cache lookup. Only that one RPC is wasted
+                    # on a cache hit; the paid rerank below waits for a confirmed miss.
+                    query_embedding = work['embedding'].result()
+                    candidates = work['candidates']
+                    cached = find_cached_response(query_embedding, selected_author, selected_type)
+                    
+                    if cached:
+                        if cached['sources']:
+                            render_sources(cached['sources'])
+                        replay_response(st.empty(), cached['response'])
+                        save_message(session_id, "assistant", cached['response'])
+                        st.stop()
+                    
+                    try:
+                        sources = rerank_sources(prompt, candidates.result(), num_sources)
+                    except Exception as e:
+                        st.error(f"Search error: {str(e)}")
+                        sources = []
+                    
+                    if not sources:
+                        st.error("No relevant sources found. Try different filters.")
+                        st.stop()
                     
-                    message_placeholder = st.empty()
-                    full_response = ""
+                    # Static instructions first and retrieved context second, so every
+                    # request shares the same long prefix and OpenAI's prompt cache applies
+                    context_message, sources = build_context_message(sources)
                     
-                    for chunk in response:
-                        if chunk.choices[0].delta.content:
-                            full_response += chunk.choices[0].delta.content
-                            message_placeholder.markdown(full_response + "▌")
+                    # Sources are known before generation starts; show them above the
+                    # answer so they can be opened while it streams in
+                    render_sources(sources)
                     
-                    message_placeholder.markdown(full_response)
+                    # gpt-4o-mini has a 200K TPM limit
+                    full_response = stream_completion([
+                        {"role": "system", "content": SYSTEM_PREAMBLE},
+                        {"role": "system", "content": context_message},
+                        {"role": "user", "content": prompt}
+                    ], response_detail)
                     
-                    # Show sources
-                    with st.expander(f"📚 {len(sources)} Sources Used", expanded=False):
-                        for i, source in enumerate(sources, 1):
-                            st.markdown(f"### [{i}] {source['title']}")
-                            st.caption(f"**{source['author']}** • {source['type'].capitalize()}")
-                            
-                            if source['url']:
-                                st.markdown(f"🔗 [View Source]({source['url']})")
-                            
-                            similarity_pct = round(source['similarity'] * 100, 1)
-                            st.progress(source['similarity'], text=f"Relevance: {similarity_pct}%")
-                            
-                            with st.expander("Preview"):
-                                st.markdown(f"_{source['matched_chunk'][:300]}..._")
-                            
-                            st.markdown("---")
+                    save_message(session_id, "assistant", full_response)
+                    cache_response(query_embedding, selected_author, selected_type, prompt, full_response, sources)
                     
-                    st.session_state.messages.append({"role": "assistant", "content": full_response})
+                except openai.BadRequestError as e:
+                    if e.code == 'context_length_exceeded':
+                        st.error("❌ The selected sources are too long for the model. Try fewer sources or a lower response detail.")
+                    else:
+                        st.error(f"❌ Error: {e.message}")
+                    if DEBUG:
+                        with st.expander("Debug Info"):
+                            st.code(traceback.format_exc())
                     
                 except Exception as e:
                     st.error(f"❌ Error: {str(e)}")
-                    with st.expander("Debug Info"):
-                        st.code(str(e))
\ No newline at end of file
+                    if DEBUG:
+                        with st.expander("Debug Info"):
+                            st.code(traceback.format_exc())
+
+st.title("📚 Islamic Scholar AI - Dawah Assistant")
+st.caption("Islamic guidance grounded in authentic sources")
+
+col1, col2 = st.columns([2, 1])
+
+with col2:
+    settings_panel(authors, source_types, db_stats, session_id)
+
+with col1:
+    chat_panel(session_id)
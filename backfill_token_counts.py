@@ -0,0 +1,30 @@
+"""Fill in source_documents.token_count for documents ingested without one.
+
+Usage: SUPABASE_URL=... SUPABASE_KEY=... python backfill_token_counts.py
+"""
+import os
+
+import tiktoken
+from supabase import create_client
+
+BATCH_SIZE = 100
+
+def main():
+    supabase = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"])
+    encoder = tiktoken.encoding_for_model("gpt-4o-mini")
+    updated = 0
+    
+    while True:
+        result = supabase.table('source_documents').select('id, content').is_('token_count', 'null').limit(BATCH_SIZE).execute()
+        if not result.data:
+            break
+        
+        for doc in result.data:
+            token_count = len(encoder.encode(doc['content'] or ""))
+            supabase.table('source_documents').update({'token_count': token_count}).eq('id', doc['id']).execute()
+            updated += 1
+        
+        print(f"Updated {updated} documents")
+
+if __name__ == "__main__":
+    main()
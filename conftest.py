@@ -0,0 +1,2 @@
+# Present so pytest puts the repository root on sys.path, letting tests import
+# the top-level modules (e.g. query_normalization) directly.
@@ -0,0 +1,20 @@
+import unicodedata
+
+
+def normalize_query(text):
+    """Case-, punctuation- and whitespace-insensitive form of a query, used as a cache key.
+    
+    Only Unicode punctuation (categories P*) is dropped, so Arabic harakat,
+    shadda and sukun (combining marks) stay attached to their letters, and
+    punctuation between digits is kept so verse references like 2:256 survive.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    chars = [
+        " " if unicodedata.category(ch).startswith("P") and not _between_digits(text, i) else ch
+        for i, ch in enumerate(text)
+    ]
+    return " ".join("".join(chars).split())
+
+
+def _between_digits(text, i):
+    return 0 < i < len(text) - 1 and text[i - 1].isdigit() and text[i + 1].isdigit()
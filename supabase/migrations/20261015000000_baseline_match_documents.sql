@@ -0,0 +1,25 @@
+-- Baseline for match_documents_hybrid as it stood before these migrations.
+-- The function was created by hand in the dashboard and never committed. The
+-- app only ever called it as match_documents_hybrid(query_embedding,
+-- match_count), so no query text reached it and it had no keyword half for
+-- the rewrites below to lose.
+--
+-- Stop here if the live database disagrees: any overload other than
+-- (vector, integer) means the later migrations would replace logic this
+-- repo has never seen. In that case export the live definition with
+-- supabase/scripts/dump_match_documents_hybrid.sql, commit it in place of
+-- this check, and port it into the later migrations.
+do $$
+declare
+    overload regprocedure;
+begin
+    for overload in
+        select pg_proc.oid::regprocedure
+        from pg_proc
+        where pg_proc.proname = 'match_documents_hybrid'
+          and pg_proc.proargtypes::regtype[] <> array['vector', 'integer']::regtype[]
+    loop
+        raise exception 'unexpected live overload %; commit its definition as the baseline first', overload;
+    end loop;
+end;
+$$;
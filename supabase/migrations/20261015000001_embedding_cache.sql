@@ -0,0 +1,10 @@
+-- Persistent cache of query embeddings so repeated prompts skip the OpenAI call.
+-- Rows are keyed by sha256(model || '\0' || prompt), see _embedding_cache_key in app.py.
+create table if not exists embedding_cache (
+    key text primary key,
+    model text not null,
+    embedding real[] not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists embedding_cache_created_at_idx on embedding_cache (created_at);
@@ -0,0 +1,73 @@
+-- Distinct filter values for the sidebar, computed in Postgres instead of
+-- shipping every source_documents row to the app.
+--
+-- Postgres has no skip scan, so SELECT DISTINCT still reads every row. Emulate
+-- one with a recursive CTE that hops from each value to the next larger one
+-- through the btree indexes on source_documents(author) / (source_type): one
+-- index probe per distinct value, independent of the number of documents.
+create index if not exists source_documents_author_idx on source_documents (author);
+create index if not exists source_documents_source_type_idx on source_documents (source_type);
+
+create or replace function get_distinct_authors()
+returns table (author text)
+language sql stable
+as $$
+    with recursive distinct_authors (value) as (
+        (
+            select source_documents.author
+            from source_documents
+            where source_documents.author is not null
+            order by source_documents.author
+            limit 1
+        )
+        union all
+        select (
+            select source_documents.author
+            from source_documents
+            where source_documents.author > distinct_authors.value
+            order by source_documents.author
+            limit 1
+        )
+        from distinct_authors
+        where distinct_authors.value is not null
+    )
+    select distinct_authors.value from distinct_authors where distinct_authors.value is not null;
+$$;
+
+create or replace function get_distinct_source_types()
+returns table (source_type text)
+language sql stable
+as $$
+    with recursive distinct_types (value) as (
+        (
+            select source_documents.source_type
+            from source_documents
+            where source_documents.source_type is not null
+            order by source_documents.source_type
+            limit 1
+        )
+        union all
+        select (
+            select source_documents.source_type
+            from source_documents
+            where source_documents.source_type > distinct_types.value
+            order by source_documents.source_type
+            limit 1
+        )
+        from distinct_types
+        where distinct_types.value is not null
+    )
+    select distinct_types.value from distinct_types where distinct_types.value is not null;
+$$;
+
+-- Both sidebar filter lists in a single round trip, reusing the loose index
+-- scans behind get_distinct_authors() / get_distinct_source_types().
+create or replace function get_filter_options()
+returns json
+language sql stable
+as $$
+    select json_build_object(
+        'authors', coalesce((select array_agg(author) from get_distinct_authors()), '{}'),
+        'source_types', coalesce((select array_agg(source_type) from get_distinct_source_types()), '{}')
+    );
+$$;
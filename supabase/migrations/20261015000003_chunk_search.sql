@@ -0,0 +1,177 @@
+-- Chunk search in one pass over document_chunks, for match_documents_hybrid:
+--   * author / source_type are denormalized onto document_chunks (kept in
+--     sync by triggers) so filters apply to the vector scan without a join
+--   * embeddings are stored as halfvec (fp16, half the size of vector)
+--   * text-embedding-3-small's 512-d embeddings are the leading components of
+--     the full vector, re-normalized, so embedding_512 is derived from the
+--     stored 1536-d embedding instead of re-embedding the corpus
+--   * a binary-quantized copy of embedding_512 (64 bytes per vector) is
+--     indexed with HNSW; search runs a Hamming pass over it, then reranks the
+--     candidates by fp16 cosine distance and keeps the best chunk per parent
+--
+-- embedding keeps all 1536 dimensions, so switching back only means indexing
+-- binary_quantize(embedding)::bit(1536) and pointing the function at it.
+-- Measure recall on a held-out query set before dropping that column.
+--
+-- Output columns are the ones match_sources reads; parent_id is returned as
+-- text so the function works whether source_documents.id is bigint or uuid.
+
+-- Drop every existing overload rather than guess the live signature, so no
+-- stale one is left for PostgREST to find ambiguous.
+do $$
+declare
+    overload regprocedure;
+begin
+    for overload in
+        select pg_proc.oid::regprocedure from pg_proc where pg_proc.proname = 'match_documents_hybrid'
+    loop
+        execute format('drop function %s', overload);
+    end loop;
+end;
+$$;
+
+-- Any existing vector index on embedding (IVFFlat, HNSW, DiskANN) is built for
+-- the old vector type and would only be rebuilt and then abandoned below.
+do $$
+declare
+    index_name text;
+begin
+    for index_name in
+        select indexname from pg_indexes
+        where tablename = 'document_chunks'
+          and (indexdef ilike '%using ivfflat%' or indexdef ilike '%using hnsw%' or indexdef ilike '%using diskann%')
+    loop
+        execute format('drop index if exists %I', index_name);
+    end loop;
+end;
+$$;
+
+-- Static per-document token counts (see backfill_token_counts.py), returned
+-- so the app does not re-tokenize every retrieved document per query.
+alter table source_documents add column if not exists token_count int;
+
+-- The backfill writes a new version of every row; the single rewrite below
+-- (type change plus the stored generated column in one ALTER) then compacts
+-- them, so the table is rewritten once.
+alter table document_chunks
+    add column if not exists author text,
+    add column if not exists source_type text;
+
+update document_chunks
+set author = source_documents.author, source_type = source_documents.source_type
+from source_documents
+where source_documents.id = document_chunks.document_id;
+
+alter table document_chunks
+    alter column embedding type halfvec(1536) using embedding::halfvec(1536),
+    add column if not exists embedding_512 halfvec(512)
+        generated always as (l2_normalize(subvector(embedding, 1, 512))::halfvec(512)) stored;
+
+create index if not exists document_chunks_author_idx on document_chunks (author);
+create index if not exists document_chunks_source_type_idx on document_chunks (source_type);
+create index if not exists document_chunks_embedding_512_bit_idx
+    on document_chunks using hnsw ((binary_quantize(embedding_512)::bit(512)) bit_hamming_ops);
+
+create or replace function copy_parent_filters_to_chunk()
+returns trigger
+language plpgsql
+as $$
+begin
+    select source_documents.author, source_documents.source_type
+    into new.author, new.source_type
+    from source_documents
+    where source_documents.id = new.document_id;
+    return new;
+end;
+$$;
+
+drop trigger if exists document_chunks_parent_filters on document_chunks;
+create trigger document_chunks_parent_filters
+    before insert or update of document_id on document_chunks
+    for each row execute function copy_parent_filters_to_chunk();
+
+create or replace function propagate_parent_filters()
+returns trigger
+language plpgsql
+as $$
+begin
+    update document_chunks
+    set author = new.author, source_type = new.source_type
+    where document_chunks.document_id = new.id;
+    return null;
+end;
+$$;
+
+drop trigger if exists source_documents_filters_changed on source_documents;
+create trigger source_documents_filters_changed
+    after update of author, source_type on source_documents
+    for each row
+    when (old.author is distinct from new.author or old.source_type is distinct from new.source_type)
+    execute function propagate_parent_filters();
+
+create or replace function match_documents_hybrid(
+    query_embedding vector(512),
+    match_count int,
+    author_filter text default null,
+    type_filter text default null
+)
+returns table (
+    parent_id text,
+    parent_title text,
+    parent_content text,
+    parent_type text,
+    parent_author text,
+    parent_metadata jsonb,
+    parent_url text,
+    parent_token_count int,
+    chunk_preview text,
+    chunk_content text,
+    similarity float
+)
+language sql stable
+security invoker
+-- Iterative scans keep the HNSW scan going past ef_search, so the coarse pool
+-- below can grow with match_count
+set hnsw.ef_search = 100
+set hnsw.iterative_scan = relaxed_order
+as $$
+    with coarse as (
+        select document_chunks.id, document_chunks.document_id, document_chunks.embedding_512 as embedding
+        from document_chunks
+        where (author_filter is null or document_chunks.author = author_filter)
+          and (type_filter is null or document_chunks.source_type = type_filter)
+        order by binary_quantize(document_chunks.embedding_512)::bit(512) <~> binary_quantize(query_embedding)
+        limit greatest(100, match_count * 10)
+    ),
+    candidates as (
+        select
+            coarse.id,
+            coarse.document_id,
+            1 - (coarse.embedding <=> query_embedding::halfvec(512)) as similarity
+        from coarse
+        order by coarse.embedding <=> query_embedding::halfvec(512)
+        limit match_count * 3
+    ),
+    best_per_parent as (
+        select distinct on (candidates.document_id) *
+        from candidates
+        order by candidates.document_id, candidates.similarity desc
+    )
+    select
+        source_documents.id::text,
+        source_documents.title,
+        source_documents.content,
+        source_documents.source_type,
+        source_documents.author,
+        source_documents.metadata,
+        source_documents.url,
+        source_documents.token_count,
+        left(document_chunks.content, 400),
+        document_chunks.content,
+        best_per_parent.similarity
+    from best_per_parent
+    join source_documents on source_documents.id = best_per_parent.document_id
+    join document_chunks on document_chunks.id = best_per_parent.id
+    order by best_per_parent.similarity desc
+    limit match_count;
+$$;
@@ -0,0 +1,53 @@
+-- Chat history per browser session, so it lives in Postgres rather than in
+-- Streamlit's never-reclaimed st.session_state.
+create table if not exists chat_messages (
+    id bigint generated always as identity primary key,
+    session_id text not null,
+    role text not null check (role in ('user', 'assistant')),
+    content text not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists chat_messages_session_idx on chat_messages (session_id, id);
+
+-- Session ids are the only key, so the table is closed to the API roles
+-- (RLS on, no policies) and the app goes through these functions, which
+-- need the session id and cannot list other sessions.
+alter table chat_messages enable row level security;
+
+create or replace function get_chat_messages(chat_session_id text, since timestamptz, max_messages int)
+returns table (role text, content text)
+language sql stable
+security definer
+set search_path = public
+as $$
+    select latest.role, latest.content
+    from (
+        select chat_messages.id, chat_messages.role, chat_messages.content
+        from chat_messages
+        where chat_messages.session_id = chat_session_id
+          and chat_messages.created_at >= since
+        order by chat_messages.id desc
+        limit max_messages
+    ) as latest
+    order by latest.id;
+$$;
+
+create or replace function add_chat_message(chat_session_id text, message_role text, message_content text)
+returns void
+language sql
+security definer
+set search_path = public
+as $$
+    insert into chat_messages (session_id, role, content)
+    values (chat_session_id, message_role, message_content);
+$$;
+
+create or replace function clear_chat_messages(chat_session_id text)
+returns void
+language sql
+security definer
+set search_path = public
+as $$
+    delete from chat_messages where chat_messages.session_id = chat_session_id;
+$$;
@@ -0,0 +1,19 @@
+-- count(*) scans the whole table. Past a million rows the sidebar does not
+-- need an exact figure, so use the planner's reltuples estimate (O(1)) there
+-- and only count exactly for smaller tables. The uncorrelated count(*)
+-- subqueries run as init plans, which are only evaluated if referenced.
+create or replace function get_db_stats()
+returns json
+language sql stable
+as $$
+    with estimates as (
+        select
+            (select reltuples::bigint from pg_class where oid = 'source_documents'::regclass) as docs,
+            (select reltuples::bigint from pg_class where oid = 'document_chunks'::regclass) as chunks
+    )
+    select json_build_object(
+        'docs', case when estimates.docs > 1000000 then estimates.docs else (select count(*) from source_documents) end,
+        'chunks', case when estimates.chunks > 1000000 then estimates.chunks else (select count(*) from document_chunks) end
+    )
+    from estimates;
+$$;
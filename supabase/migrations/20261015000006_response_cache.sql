@@ -0,0 +1,79 @@
+-- Semantic cache of completed answers. A new question reuses a cached answer
+-- when it was asked under the same filters and its embedding is within
+-- match_threshold cosine similarity of a previous question.
+create table if not exists response_cache (
+    id bigint generated always as identity primary key,
+    author text not null,
+    source_type text not null,
+    embedding vector(512) not null,
+    prompt text not null,
+    response text not null,
+    -- display fields of the sources behind the answer, re-shown on a hit
+    sources jsonb not null default '[]',
+    created_at timestamptz not null default now()
+);
+
+create index if not exists response_cache_embedding_idx
+    on response_cache using hnsw (embedding vector_cosine_ops);
+
+create or replace function match_response_cache(
+    query_embedding vector(512),
+    author_filter text,
+    type_filter text,
+    match_threshold float,
+    match_count int default 1,
+    max_age_hours int default 168
+)
+returns table (id bigint, prompt text, response text, sources jsonb, similarity float)
+language sql stable
+as $$
+    select
+        response_cache.id,
+        response_cache.prompt,
+        response_cache.response,
+        response_cache.sources,
+        1 - (response_cache.embedding <=> query_embedding) as similarity
+    from response_cache
+    where response_cache.author = author_filter
+      and response_cache.source_type = type_filter
+      and response_cache.created_at > now() - make_interval(hours => max_age_hours)
+      and response_cache.embedding <=> query_embedding < 1 - match_threshold
+    order by response_cache.embedding <=> query_embedding
+    limit match_count;
+$$;
+
+-- Newly ingested documents may change the best answer, so drop cached answers
+-- whose filters could have retrieved them: the 'All' rows plus any row for
+-- an inserted author or source type. One statement per ingest batch.
+-- Retrieval only sees a document once its chunks are embedded, which can be
+-- minutes after the source_documents row, so document_chunks inserts
+-- invalidate too; both tables carry author and source_type.
+create or replace function invalidate_response_cache()
+returns trigger
+language plpgsql
+as $$
+begin
+    delete from response_cache
+    where (response_cache.author = 'All Sources'
+           or response_cache.author in (select inserted.author from inserted))
+      and (response_cache.source_type = 'All Types'
+           or response_cache.source_type in (select inserted.source_type from inserted));
+    return null;
+end;
+$$;
+
+drop trigger if exists source_documents_invalidate_response_cache on source_documents;
+
+create trigger source_documents_invalidate_response_cache
+    after insert on source_documents
+    referencing new table as inserted
+    for each statement
+    execute function invalidate_response_cache();
+
+drop trigger if exists document_chunks_invalidate_response_cache on document_chunks;
+
+create trigger document_chunks_invalidate_response_cache
+    after insert on document_chunks
+    referencing new table as inserted
+    for each statement
+    execute function invalidate_response_cache();
@@ -0,0 +1,19 @@
+-- The app only reads recent rows from its history and cache tables, but
+-- nothing deleted the old ones. Purge rows past the app's windows hourly with
+-- pg_cron (CHAT_HISTORY_MAX_AGE, EMBEDDING_CACHE_MAX_AGE and the longest
+-- match_response_cache window in app.py), with some slack on chat history.
+create extension if not exists pg_cron;
+
+create index if not exists chat_messages_created_at_idx on chat_messages (created_at);
+create index if not exists response_cache_created_at_idx on response_cache (created_at);
+
+create or replace function purge_expired_rows()
+returns void
+language sql
+as $$
+    delete from chat_messages where chat_messages.created_at < now() - interval '1 day';
+    delete from embedding_cache where embedding_cache.created_at < now() - interval '30 days';
+    delete from response_cache where response_cache.created_at < now() - interval '7 days';
+$$;
+
+select cron.schedule('purge-expired-rows', '17 * * * *', 'select purge_expired_rows()');
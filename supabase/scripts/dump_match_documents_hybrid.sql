@@ -0,0 +1,6 @@
+-- Print the live definition of every match_documents_hybrid overload, for
+-- committing as the baseline migration when it differs from what the repo
+-- expects (see 20261015000000_baseline_match_documents.sql).
+select pg_get_functiondef(pg_proc.oid)
+from pg_proc
+where pg_proc.proname = 'match_documents_hybrid';
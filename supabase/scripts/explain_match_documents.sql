@@ -0,0 +1,14 @@
+-- Check that the nearest-neighbour step of match_documents_hybrid uses the
+-- vector index. Run in the Supabase SQL editor; the plan for the inner scan
+-- should show "Index Scan using document_chunks_embedding_512_bit_idx", not a
+-- "Seq Scan" followed by a Sort. A stored chunk embedding stands in for a
+-- query embedding.
+set hnsw.ef_search = 100;
+set hnsw.iterative_scan = relaxed_order;
+
+explain (analyze, buffers)
+select document_chunks.document_id, document_chunks.content, document_chunks.embedding_512
+from document_chunks
+order by binary_quantize(document_chunks.embedding_512)::bit(512)
+    <~> binary_quantize((select embedding_512 from document_chunks limit 1))
+limit 100;
@@ -0,0 +1,15 @@
+from query_normalization import normalize_query
+
+
+def test_case_punctuation_and_whitespace_are_ignored():
+    assert normalize_query("Is music  HARAM?") == normalize_query("is music haram")
+
+
+def test_vowelled_arabic_keeps_its_diacritics():
+    assert normalize_query("ما معنى التَّوْحِيد؟") == "ما معنى التَّوْحِيد"
+    assert normalize_query("بِسْمِ اللَّهِ الرَّحْمَٰنِ الرَّحِيمِ") == "بِسْمِ اللَّهِ الرَّحْمَٰنِ الرَّحِيمِ"
+
+
+def test_verse_references_survive():
+    assert normalize_query("What does Surah 2:256 say?") == "what does surah 2:256 say"
+    assert normalize_query("Quran 21:30, 23:12-14.") == "quran 21:30 23:12-14"